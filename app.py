@@ -1,19 +1,81 @@
-from flask import Flask, request, jsonify
+from quart import Quart, Response, request, jsonify
+from quart.json.provider import JSONProvider
+from google.ads.googleads import client as google_ads_client_module
 from google.ads.googleads.client import GoogleAdsClient
 from google.ads.googleads.errors import GoogleAdsException
-import pandas as pd
-import matplotlib.pyplot as plt
+from cachetools import LRUCache, TTLCache
+import grpc
+import msgspec
+import orjson
+import asyncio
+import concurrent.futures
+import functools
+import heapq
+import html
+import inspect
+import logging
 import os
 import io
-import base64
+import secrets
+import threading
+from types import MappingProxyType
+from typing import Annotated, Literal
 from dotenv import load_dotenv
 
 # Load environment variables from .env file for local development
 load_dotenv()
 
-app = Flask(__name__)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
 
+class OrjsonProvider(JSONProvider):
+    # orjson encodes the large keyword idea lists several times faster than the stdlib
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+
+# Cap concurrent outbound Google Ads calls per process to stay within QPS limits
+google_ads_semaphore = asyncio.Semaphore(int(os.environ.get('GOOGLE_ADS_MAX_CONCURRENCY', 8)))
+
+# Recent keyword idea results, and futures for identical requests still in flight
+keyword_ideas_cache = TTLCache(maxsize=1024, ttl=300)
+keyword_ideas_in_flight = {}
+
+# Rendered PNG charts, served by token from /visualization/<token>.
+# Kept in process memory, so the app must run as a single worker (see .dockerfile)
+visualization_cache = TTLCache(maxsize=256, ttl=300)
+
+# Dedicated thread for matplotlib so PNG rendering never blocks the event loop.
+# Renders share one figure under a lock, so more workers would only queue up
+visualization_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+png_figure_lock = threading.Lock()
+
+# gzip the large keyword protos on the wire and ping the connection during
+# long calls so a dead channel is noticed instead of hanging the request.
+# GoogleAdsClient has no public hook for channel arguments, so these are added
+# to the (private) option list it passes to every channel it creates.
+GRPC_CHANNEL_OPTIONS = [
+    ("grpc.default_compression_algorithm", int(grpc.Compression.Gzip)),
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+]
+google_ads_channel_options = getattr(google_ads_client_module, "_GRPC_CHANNEL_OPTIONS", None)
+if isinstance(google_ads_channel_options, list):
+    google_ads_channel_options.extend(
+        [option for option in GRPC_CHANNEL_OPTIONS if option not in google_ads_channel_options]
+    )
+else:
+    logger.warning("google-ads no longer exposes _GRPC_CHANNEL_OPTIONS; gRPC compression and keepalive are disabled")
+
+@functools.lru_cache(maxsize=1)
 def get_google_ads_client():
+    # Built once per process: loading the config and setting up gRPC is too
+    # expensive to repeat on every request
     # Check if we have a config file, otherwise use env vars
     if os.path.exists("google-ads.yaml"):
         return GoogleAdsClient.load_from_storage("google-ads.yaml")
@@ -29,205 +91,500 @@ def get_google_ads_client():
         }
         return GoogleAdsClient.load_from_dict(credentials)
 
+def get_google_ads_service(name):
+    # Prefer the asyncio client so RPCs are awaited on the event loop instead of
+    # tying up executor threads; older google-ads releases only have blocking stubs.
+    # Async channels bind to the running loop, so build these from inside it
+    client = get_google_ads_client()
+    try:
+        return client.get_service(name, is_async=True)
+    except (TypeError, ValueError):
+        return client.get_service(name)
+
+@functools.lru_cache(maxsize=1)
+def get_keyword_plan_idea_service():
+    # Reuse one service stub (and its gRPC channel) across requests
+    return get_google_ads_service("KeywordPlanIdeaService")
+
+@functools.lru_cache(maxsize=1)
+def get_geo_target_constant_service():
+    return get_google_ads_service("GeoTargetConstantService")
+
+async def run_blocking(func):
+    # Fallback for blocking stubs: run the call on an executor thread. A running
+    # thread can't be interrupted, so if we're cancelled keep waiting until it
+    # returns; callers holding google_ads_semaphore keep their slot until then
+    future = asyncio.get_running_loop().run_in_executor(None, func)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        while not future.done():
+            try:
+                await asyncio.wait({future})
+            except asyncio.CancelledError:
+                pass
+        if not future.cancelled():
+            future.exception()  # The result is discarded; don't warn about it
+        raise
+
+@app.before_serving
+async def warm_google_ads_client():
+    try:
+        get_keyword_plan_idea_service()
+    except Exception:
+        # Don't block startup; requests will retry building the client
+        logger.exception("Could not initialise Google Ads client")
+
 @app.route('/', methods=['GET'])
-def home():
+async def home():
     return jsonify({
         "message": "Google Ads API Service",
         "endpoints": {
             "/health": "Health check endpoint",
-            "/api/keyword-ideas": "Get keyword ideas from Google Ads API"
+            "/api/keyword-ideas": "Get keyword ideas from Google Ads API",
+            "/visualization/<token>": "Fetch a rendered PNG chart"
         }
     })
 
 @app.route('/health', methods=['GET'])
-def health_check():
+async def health_check():
     return jsonify({"status": "healthy"})
 
+MAX_COMPETITORS_DOMAINS = 5
+
+class KeywordIdeasRequest(msgspec.Struct):
+    customer_id: str = ""
+    keywords: list[str] = []
+    # Accept simple codes like 'en' and 'US' as well as Google Ads resource names
+    language: str = 'en'
+    location: str = 'US'
+    page_url: str | None = None
+    # Each competitor domain costs its own Google Ads call, so keep the list short
+    competitors_domains: Annotated[list[str], msgspec.Meta(max_length=MAX_COMPETITORS_DOMAINS)] = []
+    create_visualization: bool = True
+    # 'data', 'svg' or 'png'; unset means SVG if the client accepts it, chart data otherwise
+    visualization_format: Literal['data', 'svg', 'png'] | None = None
+
+# Decodes and validates the request body in a single pass
+keyword_ideas_request_decoder = msgspec.json.Decoder(KeywordIdeasRequest)
+
 @app.route('/api/keyword-ideas', methods=['POST'])
-def get_keyword_ideas():
+async def get_keyword_ideas():
     try:
-        data = request.json
-        customer_id = data.get('customer_id')
-        keywords = data.get('keywords', [])
-        
-        # Get language and location parameters (changing parameter names for clarity)
-        language = data.get('language', 'en')  # Accept simple codes like 'en'
-        location = data.get('location', 'US')  # Accept simple codes like 'US'
-        page_url = data.get('page_url')
-        competitors_domains = data.get('competitors_domains', [])
+        try:
+            # Raw body straight into msgspec; nothing else reads it, so don't keep a copy
+            data = keyword_ideas_request_decoder.decode(await request.get_data(cache=False))
+        except msgspec.DecodeError as e:
+            return jsonify({"error": f"Invalid request body: {e}"}), 400
         
-        if not customer_id:
+        if not data.customer_id:
             return jsonify({"error": "Missing required parameter: customer_id"}), 400
             
-        if not keywords and not page_url and not competitors_domains:
+        if not data.keywords and not data.page_url and not data.competitors_domains:
             return jsonify({"error": "You must provide at least one of: keywords, page_url, or competitors_domains"}), 400
         
+        # Response schema: rounded currency values by default, raw bid micros on request
+        response_format = request.args.get('format', 'dollars')
+        keyword_idea_formatter = KEYWORD_IDEA_FORMATTERS.get(response_format)
+        if keyword_idea_formatter is None:
+            return jsonify({"error": f"Unsupported format: {response_format}"}), 400
+        
         # Get client
         client = get_google_ads_client()
         
         # Get keyword ideas using the client
-        keyword_ideas = generate_keyword_ideas(
+        keyword_ideas = await generate_keyword_ideas(
             client,
-            customer_id,
-            keywords,
-            language,
-            location,
-            page_url,
-            competitors_domains
+            data.customer_id,
+            data.keywords,
+            data.language,
+            data.location,
+            data.page_url,
+            data.competitors_domains
         )
         
-        # Format the response
-        formatted_results = []
-        for idea in keyword_ideas:
-            # Convert micros (millionths of a currency unit) to actual currency values
-            low_top_of_page_bid = idea.keyword_idea_metrics.low_top_of_page_bid_micros / 1000000 if idea.keyword_idea_metrics.low_top_of_page_bid_micros else 0
-            high_top_of_page_bid = idea.keyword_idea_metrics.high_top_of_page_bid_micros / 1000000 if idea.keyword_idea_metrics.high_top_of_page_bid_micros else 0
-            
-            formatted_results.append({
-                "text": idea.text,
-                "search_volume": idea.keyword_idea_metrics.avg_monthly_searches,
-                "competition": str(idea.keyword_idea_metrics.competition),
-                "competition_index": idea.keyword_idea_metrics.competition_index,
-                "low_top_of_page_bid": round(low_top_of_page_bid, 2),
-                "high_top_of_page_bid": round(high_top_of_page_bid, 2),
-            })
-        
         # Create visualization if requested and if we have data
-        visualization_url = None
-        if formatted_results and data.get('create_visualization', True):
-            visualization_url = create_visualization(formatted_results)
-        
-        response_data = {"keyword_ideas": formatted_results}
-        if visualization_url:
-            response_data["visualization"] = visualization_url
+        # Chart data is returned by default; the rendered PNG is kept for legacy clients
+        response_extra = {}
+        if keyword_ideas and data.create_visualization:
+            top_results = [format_keyword_idea(idea) for idea in heapq.nlargest(
+                15, keyword_ideas, key=lambda idea: idea.keyword_idea_metrics.avg_monthly_searches
+            )]
+            visualization_format = data.visualization_format
+            if visualization_format is None:
+                visualization_format = 'svg' if 'image/svg+xml' in request.headers.get('Accept', '') else 'data'
             
-        return jsonify(response_data)
+            if visualization_format == 'svg':
+                response_extra["visualization"] = create_svg_visualization(top_results)
+            elif visualization_format == 'png':
+                # Served separately so the image isn't base64-encoded into the JSON
+                token = secrets.token_urlsafe(12)
+                visualization_cache[token] = await asyncio.get_running_loop().run_in_executor(
+                    visualization_executor, create_png_visualization, top_results
+                )
+                response_extra["visualization_url"] = f"/visualization/{token}"
+            else:
+                response_extra["visualization"] = create_visualization(top_results)
+        
+        # Stream the keyword ideas out instead of building the whole formatted list in memory.
+        # Errors past this point can't be turned into an error response (see stream_keyword_ideas)
+        return Response(
+            stream_keyword_ideas(keyword_ideas, keyword_idea_formatter, response_extra),
+            mimetype="application/json"
+        )
         
     except GoogleAdsException as ex:
         error_message = f"Google Ads API error: {ex.error.code().name}"
         detail_message = ex.failure.errors[0].message if ex.failure.errors else str(ex)
-        print(f"Request made: {ex}")  # Log the full error for debugging
+        logger.exception("Google Ads request failed")  # Log the full error for debugging
         return jsonify({
             "error": error_message,
             "detail": detail_message
         }), 400
         
     except Exception as e:
-        import traceback
-        print(f"Unexpected error: {traceback.format_exc()}")  # Log the full error for debugging
+        logger.exception("Unexpected error")  # Log the full error for debugging
         return jsonify({"error": str(e)}), 500
 
-def generate_keyword_ideas(client, customer_id, keywords=None, language='en', location='US', page_url=None, competitors_domains=None):
-    keyword_plan_idea_service = client.get_service("KeywordPlanIdeaService")
-    
-    # Map language codes to Google Ads language constants
-    language_mapping = {
-        "en": "languageConstants/1000",  # English
-        "es": "languageConstants/1003",  # Spanish
-        "fr": "languageConstants/1002",  # French
-        "de": "languageConstants/1001",  # German
-        "pt": "languageConstants/1014",  # Portuguese
-        "it": "languageConstants/1004",  # Italian
-        "ru": "languageConstants/1031",  # Russian
-        "ja": "languageConstants/1005",  # Japanese
-        "zh": "languageConstants/1017",  # Chinese (Simplified)
+def format_competition(competition):
+    # The "KeywordPlanCompetitionLevel.HIGH" form str() gave on Python 3.9; from
+    # 3.11 str() of an IntEnum is just the number
+    return f"{type(competition).__name__}.{competition.name}"
+
+def format_keyword_idea(idea):
+    # Convert micros (millionths of a currency unit) to actual currency values
+    metrics = idea.keyword_idea_metrics
+    return {
+        "text": idea.text,
+        "search_volume": metrics.avg_monthly_searches,
+        "competition": format_competition(metrics.competition),
+        "competition_index": metrics.competition_index,
+        "low_top_of_page_bid": round((metrics.low_top_of_page_bid_micros or 0) / 1000000, 2),
+        "high_top_of_page_bid": round((metrics.high_top_of_page_bid_micros or 0) / 1000000, 2),
     }
-    
-    # Map location codes to Google Ads geo target constants
-    # This is a simplification - for production, you might want to use the GeoTargetConstantService
-    location_mapping = {
-        "US": "geoTargetConstants/2840",  # United States
-        "CA": "geoTargetConstants/2124",  # Canada
-        "GB": "geoTargetConstants/2826",  # United Kingdom
-        "AU": "geoTargetConstants/2036",  # Australia
-        "DE": "geoTargetConstants/2276",  # Germany
-        "FR": "geoTargetConstants/2250",  # France
-        "ES": "geoTargetConstants/2724",  # Spain
+
+def format_keyword_idea_micros(idea):
+    # Legacy schema: bids left in micros exactly as Google Ads returns them
+    metrics = idea.keyword_idea_metrics
+    return {
+        "text": idea.text,
+        "search_volume": metrics.avg_monthly_searches,
+        "competition": format_competition(metrics.competition),
+        "competition_index": metrics.competition_index,
+        "low_top_of_page_bid_micros": metrics.low_top_of_page_bid_micros,
+        "high_top_of_page_bid_micros": metrics.high_top_of_page_bid_micros,
     }
+
+KEYWORD_IDEA_FORMATTERS = MappingProxyType({
+    "dollars": format_keyword_idea,
+    "micros": format_keyword_idea_micros,
+})
+
+async def stream_keyword_ideas(keyword_ideas, keyword_idea_formatter, response_extra, batch_size=500):
+    # Emits {"keyword_ideas": [...], **response_extra} a batch of ideas at a time.
+    # The 200 status is sent before the first batch, so an error while formatting
+    # can't become an error response: the client just gets a truncated body
+    try:
+        yield b'{"keyword_ideas":['
+        for start in range(0, len(keyword_ideas), batch_size):
+            chunk = b','.join(
+                orjson.dumps(keyword_idea_formatter(idea))
+                for idea in keyword_ideas[start:start + batch_size]
+            )
+            yield b',' + chunk if start else chunk
+        yield b']'
+        if response_extra:
+            # Splice the extra keys in after the list, dropping their opening brace
+            yield b',' + orjson.dumps(response_extra)[1:]
+        else:
+            yield b'}'
+    except Exception:
+        logger.exception("Keyword ideas response failed mid-stream; the body is truncated")
+        raise
+
+@app.route('/visualization/<token>', methods=['GET'])
+async def get_visualization(token):
+    png_bytes = visualization_cache.get(token)
+    if png_bytes is None:
+        return jsonify({"error": "Visualization not found or expired"}), 404
+    return Response(png_bytes, mimetype='image/png')
+
+async def generate_keyword_ideas(client, customer_id, keywords=None, language='en', location='US', page_url=None, competitors_domains=None):
+    keywords = keywords or []
+    competitors_domains = competitors_domains or []
+    # Country codes are case-insensitive ('us' is 'US'); resource names are left alone
+    if location and not location.startswith("geoTargetConstants/"):
+        location = location.upper()
+    cache_key = (customer_id, language, location, tuple(sorted(keywords)), page_url, tuple(sorted(competitors_domains)))
     
-    # Build the request
-    request = client.get_type("GenerateKeywordIdeasRequest")
-    request.customer_id = customer_id
+    if cache_key in keyword_ideas_cache:
+        return keyword_ideas_cache[cache_key]
     
-    # Set the language properly
-    if language in language_mapping:
-        request.language = language_mapping[language]
-    elif language.startswith("languageConstants/"):
-        request.language = language
+    # Identical concurrent requests share one fetch. It runs in its own task so a
+    # cancelled caller (e.g. a client disconnect) doesn't cancel it for the others
+    task = keyword_ideas_in_flight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(fetch_and_cache_keyword_ideas(
+            cache_key,
+            client,
+            customer_id,
+            keywords,
+            language,
+            location,
+            page_url,
+            competitors_domains
+        ))
+        keyword_ideas_in_flight[cache_key] = task
+    
+    return await asyncio.shield(task)
+
+async def fetch_and_cache_keyword_ideas(cache_key, client, customer_id, keywords, language, location, page_url, competitors_domains):
+    try:
+        # Two-letter codes missing from LOCATION_MAPPING are resolved through Google Ads
+        # (cached per code); anything else falls back to US without an upstream call
+        if location and len(location) == 2 and location.isalpha() and location not in LOCATION_MAPPING:
+            location = await suggest_geo_target_constant(location)
+        
+        requests = build_keyword_ideas_requests(
+            client,
+            customer_id,
+            keywords,
+            language,
+            location,
+            page_url,
+            competitors_domains
+        )
+        
+        # Each seed is a separate RPC; send them concurrently and combine the ideas
+        tasks = [asyncio.ensure_future(run_keyword_ideas_request(request)) for request in requests]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # One seed failed: don't let the others keep spending quota
+            for task in tasks:
+                task.cancel()
+            raise
+        keyword_ideas = merge_keyword_ideas(results)
+        
+        keyword_ideas_cache[cache_key] = keyword_ideas
+        return keyword_ideas
+    finally:
+        del keyword_ideas_in_flight[cache_key]
+
+# Map language codes to Google Ads language constants
+LANGUAGE_MAPPING = MappingProxyType({
+    "en": "languageConstants/1000",  # English
+    "es": "languageConstants/1003",  # Spanish
+    "fr": "languageConstants/1002",  # French
+    "de": "languageConstants/1001",  # German
+    "pt": "languageConstants/1014",  # Portuguese
+    "it": "languageConstants/1004",  # Italian
+    "ru": "languageConstants/1031",  # Russian
+    "ja": "languageConstants/1005",  # Japanese
+    "zh": "languageConstants/1017",  # Chinese (Simplified)
+})
+
+# Map common location codes to Google Ads geo target constants
+# Anything else is looked up once through the GeoTargetConstantService
+LOCATION_MAPPING = MappingProxyType({
+    "US": "geoTargetConstants/2840",  # United States
+    "CA": "geoTargetConstants/2124",  # Canada
+    "GB": "geoTargetConstants/2826",  # United Kingdom
+    "AU": "geoTargetConstants/2036",  # Australia
+    "DE": "geoTargetConstants/2276",  # Germany
+    "FR": "geoTargetConstants/2250",  # France
+    "ES": "geoTargetConstants/2724",  # Spain
+})
+
+# Locations already resolved through the GeoTargetConstantService
+geo_target_constant_cache = LRUCache(maxsize=512)
+
+async def suggest_geo_target_constant(country_code):
+    if country_code in geo_target_constant_cache:
+        return geo_target_constant_cache[country_code]
+    
+    client = get_google_ads_client()
+    geo_target_constant_service = get_geo_target_constant_service()
+    
+    request = client.get_type("SuggestGeoTargetConstantsRequest")
+    request.locale = "en"
+    request.country_code = country_code
+    request.location_names.names.append(country_code)
+    
+    suggest = geo_target_constant_service.suggest_geo_target_constants
+    try:
+        async with google_ads_semaphore:
+            if inspect.iscoroutinefunction(suggest):
+                response = await suggest(request=request)
+            else:
+                response = await run_blocking(functools.partial(suggest, request=request))
+    except GoogleAdsException:
+        # Not cached, so a transient failure is retried on the next request
+        logger.warning("Could not resolve location %s, defaulting to US", country_code, exc_info=True)
+        return LOCATION_MAPPING["US"]
+    suggestions = [suggestion.geo_target_constant for suggestion in response.geo_target_constant_suggestions]
+    
+    # Prefer the country itself, then the best ranked suggestion
+    resource_name = LOCATION_MAPPING["US"]  # Default to US if nothing matches
+    for geo_target_constant in suggestions:
+        if geo_target_constant.target_type == "Country" and geo_target_constant.country_code == country_code:
+            resource_name = geo_target_constant.resource_name
+            break
     else:
-        # Default to English if not recognized
-        request.language = "languageConstants/1000"
-    
-    # Set the location properly
-    if location in location_mapping:
-        request.geo_target_constants.append(location_mapping[location])
-    elif location.startswith("geoTargetConstants/"):
-        request.geo_target_constants.append(location)
-    elif location:
-        # Use a direct approach instead of SuggestGeoTargetConstantsRequest
-        # For common country codes, use a predefined mapping
-        # For US, default to US if no mapping is found
-        request.geo_target_constants.append("geoTargetConstants/2840")  # Default to US
-    
-    # Set up the appropriate seed
-    keyword_seed = None
-    url_seed = None
-    domain_seed = None
-    
-    # Add keywords if provided
-    if keywords and len(keywords) > 0:
-        keyword_seed = client.get_type("KeywordSeed")
-        for keyword in keywords:
-            keyword_seed.keywords.append(keyword)
-        request.keyword_seed = keyword_seed
+        if suggestions:
+            resource_name = suggestions[0].resource_name
     
-    # Add page URL if provided
-    if page_url:
+    geo_target_constant_cache[country_code] = resource_name
+    return resource_name
+
+def build_keyword_ideas_requests(client, customer_id, keywords=None, language='en', location='US', page_url=None, competitors_domains=None):
+    # Set the language properly, defaulting to English if not recognized
+    language_constant = LANGUAGE_MAPPING.get(language) or (
+        language if language.startswith("languageConstants/") else "languageConstants/1000"
+    )
+    
+    # Set the location properly, defaulting to US if not recognized
+    geo_target_constant = location and (LOCATION_MAPPING.get(location) or (
+        location if location.startswith("geoTargetConstants/") else "geoTargetConstants/2840"
+    ))
+    
+    # A request carries a single seed, so collect one (field, seed) pair per request
+    seeds = []
+    
+    # Keywords and a page URL combine into one seed, otherwise use whichever was provided
+    if keywords and page_url:
+        keyword_and_url_seed = client.get_type("KeywordAndUrlSeed")
+        keyword_and_url_seed.keywords.extend(keywords)
+        keyword_and_url_seed.url = page_url
+        seeds.append(("keyword_and_url_seed", keyword_and_url_seed))
+    elif keywords:
+        keyword_seed = client.get_type("KeywordSeed")
+        keyword_seed.keywords.extend(keywords)
+        seeds.append(("keyword_seed", keyword_seed))
+    elif page_url:
         url_seed = client.get_type("UrlSeed")
         url_seed.url = page_url
-        request.url_seed = url_seed
+        seeds.append(("url_seed", url_seed))
+    
+    # A site seed takes one domain, so each competitor gets its own request
+    for domain in competitors_domains or []:
+        site_seed = client.get_type("SiteSeed")
+        site_seed.site = domain
+        seeds.append(("site_seed", site_seed))
     
-    # Add competitor domains if provided
-    if competitors_domains and len(competitors_domains) > 0:
-        domain_seed = client.get_type("SiteSeed")
-        for domain in competitors_domains:
-            domain_seed.sites.append(domain)
-        request.site_seed = domain_seed
+    requests = []
+    for seed_field, seed in seeds:
+        # Build the request
+        request = client.get_type("GenerateKeywordIdeasRequest")
+        request.customer_id = customer_id
+        request.language = language_constant
+        if geo_target_constant:
+            request.geo_target_constants.append(geo_target_constant)
+        setattr(request, seed_field, seed)
+        
+        # Only stringified when DEBUG logging is enabled
+        logger.debug("Sending request to Google Ads: %s", request)
+        requests.append(request)
+    
+    return requests
+
+async def run_keyword_ideas_request(request):
+    async with google_ads_semaphore:
+        return await fetch_keyword_ideas(request)
+
+async def fetch_keyword_ideas(request):
+    generate = get_keyword_plan_idea_service().generate_keyword_ideas
     
-    print(f"Sending request to Google Ads: {request}")  # Log the request for debugging
+    if inspect.iscoroutinefunction(generate):
+        # Follow-up pages are fetched as the async pager is drained
+        pager = await generate(request=request)
+        return [idea async for idea in pager]
     
-    # Get keyword ideas
-    keyword_ideas = keyword_plan_idea_service.generate_keyword_ideas(request=request)
+    # Blocking stub: drain the pager on the executor thread too, so follow-up
+    # page fetches don't happen on the event loop
+    return await run_blocking(lambda: list(generate(request=request)))
+
+def merge_keyword_ideas(results):
+    if len(results) == 1:
+        return results[0]
     
-    return keyword_ideas
+    # The same keyword can come back from several seeds, keep its highest search volume
+    merged = {}
+    for keyword_ideas in results:
+        for idea in keyword_ideas:
+            current = merged.get(idea.text)
+            if current is None or idea.keyword_idea_metrics.avg_monthly_searches > current.keyword_idea_metrics.avg_monthly_searches:
+                merged[idea.text] = idea
+    return list(merged.values())
+
+def top_keywords(keyword_data, n=15):
+    # Keep only the most searched keywords so charts stay readable
+    return heapq.nlargest(n, keyword_data, key=lambda d: d['search_volume'])
 
 def create_visualization(keyword_data):
-    # Convert to pandas DataFrame
-    df = pd.DataFrame(keyword_data)
-    
-    # Create visualization
-    plt.figure(figsize=(12, 6))
-    
-    # Sort by search_volume and take top 15 for readability
-    df_sorted = df.sort_values('search_volume', ascending=False).head(15)
-    
-    # Plot
-    plt.bar(df_sorted['text'], df_sorted['search_volume'])
-    plt.xticks(rotation=45, ha='right')
-    plt.xlabel('Keywords')
-    plt.ylabel('Average Monthly Searches')
-    plt.title('Keyword Popularity')
-    plt.tight_layout()
-    
-    # Save to a base64 encoded string for embedding in response
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format='png')
-    buffer.seek(0)
+    # Top keywords by search volume as chart-ready data, clients draw the bars
+    top = top_keywords(keyword_data)
+    return {
+        "labels": [d['text'] for d in top],
+        "values": [d['search_volume'] for d in top],
+    }
+
+def create_svg_visualization(keyword_data, width=1200, height=600):
+    # Hand-written SVG bar chart: no rasterising or image encoding needed
+    top = top_keywords(keyword_data)
+    chart_height = height - 150  # Leave room below the bars for the labels
+    slot_width = width / len(top)
+    bar_width = slot_width * 0.8
+    scale = chart_height / (max(d['search_volume'] for d in top) or 1)
+    
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">']
+    for i, d in enumerate(top):
+        x = i * slot_width + (slot_width - bar_width) / 2
+        bar_height = d['search_volume'] * scale
+        label_x = x + bar_width / 2
+        parts.append(
+            f'<rect x="{x:.1f}" y="{chart_height - bar_height:.1f}" width="{bar_width:.1f}" '
+            f'height="{bar_height:.1f}" fill="#4285F4"/>'
+            f'<text x="{label_x:.1f}" y="{chart_height + 15}" font-size="12" text-anchor="end" '
+            f'transform="rotate(-45 {label_x:.1f} {chart_height + 15})">{html.escape(d["text"])}</text>'
+        )
+    parts.append('</svg>')
+    return ''.join(parts)
+
+@functools.lru_cache(maxsize=1)
+def load_png_figure():
+    # Legacy server-side rendering, only imported when a client asks for a PNG.
+    # A single Figure is reused for every chart; it is created without pyplot
+    # so nothing piles up in pyplot's global figure registry
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(12, 6))
+    return fig, fig.subplots()
+
+def create_png_visualization(keyword_data):
+    top = top_keywords(keyword_data)
+    
+    # matplotlib state isn't thread-safe, so only one render uses the figure at a time
+    with png_figure_lock:
+        fig, ax = load_png_figure()
+        ax.clear()
+        
+        # Plot at numeric positions so no category state carries over between charts
+        positions = range(len(top))
+        ax.bar(positions, [d['search_volume'] for d in top])
+        ax.set_xticks(positions, [d['text'] for d in top], rotation=45, ha='right')
+        ax.set_xlabel('Keywords')
+        ax.set_ylabel('Average Monthly Searches')
+        ax.set_title('Keyword Popularity')
+        fig.tight_layout()
+        
+        # Save to PNG bytes, served as-is from /visualization/<token>
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png')
+    
     image_png = buffer.getvalue()
     buffer.close()
     
-    graphic = base64.b64encode(image_png).decode('utf-8')
-    return graphic
+    return image_png
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
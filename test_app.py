@@ -0,0 +1,281 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+
+import msgspec
+import pytest
+from google.ads.googleads.client import GoogleAdsClient
+from google.ads.googleads.errors import GoogleAdsException
+from google.auth.credentials import AnonymousCredentials
+
+import app
+
+
+def test_cancelled_caller_does_not_cancel_shared_fetch(monkeypatch):
+    app.keyword_ideas_cache.clear()
+    app.keyword_ideas_in_flight.clear()
+
+    async def run():
+        release = asyncio.Event()
+        calls = []
+
+        async def fake_run_keyword_ideas_request(request):
+            calls.append(request)
+            await release.wait()
+            return ["idea"]
+
+        monkeypatch.setattr(app, "build_keyword_ideas_requests", lambda *args: ["request"])
+        monkeypatch.setattr(app, "run_keyword_ideas_request", fake_run_keyword_ideas_request)
+
+        first = asyncio.ensure_future(app.generate_keyword_ideas(None, "123", ["shoes"]))
+        second = asyncio.ensure_future(app.generate_keyword_ideas(None, "123", ["shoes"]))
+        await asyncio.sleep(0)
+
+        # The first caller goes away while the RPC is still running
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await second == ["idea"]
+        assert first.cancelled()
+        assert calls == ["request"]
+        assert not app.keyword_ideas_in_flight
+
+    asyncio.run(run())
+
+
+def test_failed_seed_cancels_remaining_requests(monkeypatch):
+    app.keyword_ideas_cache.clear()
+    app.keyword_ideas_in_flight.clear()
+
+    async def run():
+        started = []
+
+        async def fake_run_keyword_ideas_request(request):
+            started.append(request)
+            if request == "failing":
+                raise RuntimeError("quota exhausted")
+            await asyncio.sleep(10)
+            return []
+
+        monkeypatch.setattr(app, "build_keyword_ideas_requests", lambda *args: ["failing", "slow"])
+        monkeypatch.setattr(app, "run_keyword_ideas_request", fake_run_keyword_ideas_request)
+
+        with pytest.raises(RuntimeError):
+            await app.generate_keyword_ideas(None, "123", ["shoes"], competitors_domains=["example.com"])
+
+        await asyncio.sleep(0)
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        assert not pending
+
+    asyncio.run(run())
+
+
+def test_competitors_domains_are_capped():
+    body = msgspec.json.encode({
+        "customer_id": "123",
+        "competitors_domains": [f"site{i}.com" for i in range(app.MAX_COMPETITORS_DOMAINS + 1)],
+    })
+    with pytest.raises(msgspec.ValidationError):
+        app.keyword_ideas_request_decoder.decode(body)
+
+
+def test_unknown_visualization_format_is_rejected():
+    body = msgspec.json.encode({"customer_id": "123", "visualization_format": "SVG"})
+    with pytest.raises(msgspec.ValidationError):
+        app.keyword_ideas_request_decoder.decode(body)
+
+
+def test_missing_customer_id_keeps_documented_error():
+    async def run():
+        client = app.app.test_client()
+        response = await client.post("/api/keyword-ideas", json={"keywords": ["shoes"]})
+        assert response.status_code == 400
+        assert await response.get_json() == {"error": "Missing required parameter: customer_id"}
+
+    asyncio.run(run())
+
+
+class FakeAsyncPager:
+    def __init__(self, ideas):
+        self.ideas = ideas
+
+    def __aiter__(self):
+        async def ideas():
+            for idea in self.ideas:
+                yield idea
+        return ideas()
+
+
+class FakeAsyncKeywordPlanIdeaService:
+    async def generate_keyword_ideas(self, request):
+        return FakeAsyncPager(["a", "b"])
+
+
+class FakeKeywordPlanIdeaService:
+    def generate_keyword_ideas(self, request):
+        return iter(["a", "b"])
+
+
+@pytest.mark.parametrize("service", [FakeAsyncKeywordPlanIdeaService(), FakeKeywordPlanIdeaService()])
+def test_fetch_keyword_ideas_drains_async_and_blocking_pagers(monkeypatch, service):
+    monkeypatch.setattr(app, "get_keyword_plan_idea_service", lambda: service)
+    assert asyncio.run(app.fetch_keyword_ideas("request")) == ["a", "b"]
+
+
+def test_cancelled_blocking_call_keeps_its_semaphore_slot(monkeypatch):
+    release = threading.Event()
+
+    class SlowKeywordPlanIdeaService:
+        def generate_keyword_ideas(self, request):
+            release.wait(5)
+            return iter([])
+
+    monkeypatch.setattr(app, "get_keyword_plan_idea_service", lambda: SlowKeywordPlanIdeaService())
+
+    async def run():
+        monkeypatch.setattr(app, "google_ads_semaphore", asyncio.Semaphore(1))
+        task = asyncio.ensure_future(app.run_keyword_ideas_request("request"))
+        await asyncio.sleep(0.05)
+
+        task.cancel()
+        await asyncio.sleep(0.05)
+        # The thread is still running the RPC, so its slot must not be handed out
+        assert app.google_ads_semaphore.locked()
+
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert not app.google_ads_semaphore.locked()
+
+    asyncio.run(run())
+
+
+def make_google_ads_client():
+    return GoogleAdsClient(AnonymousCredentials(), "developer-token", use_proto_plus=True)
+
+
+def test_build_keyword_ideas_requests_uses_one_seed_per_request():
+    requests = app.build_keyword_ideas_requests(
+        make_google_ads_client(),
+        "123",
+        ["shoes", "boots"],
+        "fr",
+        "FR",
+        "https://example.com",
+        ["a.com", "b.com"],
+    )
+
+    seeds = [type(request).pb(request).WhichOneof("seed") for request in requests]
+    assert seeds == ["keyword_and_url_seed", "site_seed", "site_seed"]
+    assert list(requests[0].keyword_and_url_seed.keywords) == ["shoes", "boots"]
+    assert requests[0].keyword_and_url_seed.url == "https://example.com"
+    assert [request.site_seed.site for request in requests[1:]] == ["a.com", "b.com"]
+    for request in requests:
+        assert request.customer_id == "123"
+        assert request.language == "languageConstants/1002"
+        assert list(request.geo_target_constants) == ["geoTargetConstants/2250"]
+
+
+def make_idea(text, avg_monthly_searches):
+    return SimpleNamespace(
+        text=text,
+        keyword_idea_metrics=SimpleNamespace(avg_monthly_searches=avg_monthly_searches),
+    )
+
+
+def test_merge_keyword_ideas_keeps_highest_search_volume():
+    merged = app.merge_keyword_ideas([
+        [make_idea("shoes", 10), make_idea("boots", 50)],
+        [make_idea("shoes", 30), make_idea("sandals", 5)],
+        [make_idea("boots", 20)],
+    ])
+
+    assert {idea.text: idea.keyword_idea_metrics.avg_monthly_searches for idea in merged} == {
+        "shoes": 30,
+        "boots": 50,
+        "sandals": 5,
+    }
+
+
+def test_format_competition_matches_the_original_response_value():
+    competition = make_google_ads_client().enums.KeywordPlanCompetitionLevelEnum.HIGH
+    assert app.format_competition(competition) == "KeywordPlanCompetitionLevel.HIGH"
+
+
+def make_metrics_idea(text, avg_monthly_searches):
+    competition = make_google_ads_client().enums.KeywordPlanCompetitionLevelEnum.LOW
+    return SimpleNamespace(
+        text=text,
+        keyword_idea_metrics=SimpleNamespace(
+            avg_monthly_searches=avg_monthly_searches,
+            competition=competition,
+            competition_index=10,
+            low_top_of_page_bid_micros=1250000,
+            high_top_of_page_bid_micros=None,
+        ),
+    )
+
+
+@pytest.mark.parametrize("count", [0, 1, 7])
+@pytest.mark.parametrize("response_extra", [{}, {"visualization": {"labels": ["k0"], "values": [0]}}])
+def test_stream_keyword_ideas_emits_valid_json(count, response_extra):
+    ideas = [make_metrics_idea(f"k{i}", i) for i in range(count)]
+
+    async def collect():
+        chunks = app.stream_keyword_ideas(ideas, app.format_keyword_idea, response_extra, batch_size=3)
+        return b"".join([chunk async for chunk in chunks])
+
+    body = json.loads(asyncio.run(collect()))
+
+    assert body == {"keyword_ideas": [app.format_keyword_idea(idea) for idea in ideas], **response_extra}
+
+
+@pytest.mark.parametrize("location, looked_up, geo_target_constant", [
+    ("us", None, "geoTargetConstants/2840"),
+    ("USA", None, "geoTargetConstants/2840"),
+    ("not a place", None, "geoTargetConstants/2840"),
+    ("ma", "MA", "geoTargetConstants/2504"),
+])
+def test_only_unmapped_country_codes_are_looked_up(monkeypatch, location, looked_up, geo_target_constant):
+    app.keyword_ideas_cache.clear()
+    lookups = []
+    built = {}
+    build_keyword_ideas_requests = app.build_keyword_ideas_requests
+
+    async def fake_suggest_geo_target_constant(country_code):
+        lookups.append(country_code)
+        return "geoTargetConstants/2504"
+
+    def fake_build_keyword_ideas_requests(client, customer_id, keywords, language, location, *args):
+        built["requests"] = build_keyword_ideas_requests(
+            make_google_ads_client(), customer_id, keywords, language, location
+        )
+        return built["requests"]
+
+    async def fake_run_keyword_ideas_request(request):
+        return []
+
+    monkeypatch.setattr(app, "suggest_geo_target_constant", fake_suggest_geo_target_constant)
+    monkeypatch.setattr(app, "build_keyword_ideas_requests", fake_build_keyword_ideas_requests)
+    monkeypatch.setattr(app, "run_keyword_ideas_request", fake_run_keyword_ideas_request)
+
+    asyncio.run(app.generate_keyword_ideas(None, "123", ["shoes"], location=location))
+
+    assert lookups == ([looked_up] if looked_up else [])
+    assert list(built["requests"][0].geo_target_constants) == [geo_target_constant]
+
+
+def test_failed_location_lookup_falls_back_to_us(monkeypatch):
+    app.geo_target_constant_cache.clear()
+
+    class FailingGeoTargetConstantService:
+        async def suggest_geo_target_constants(self, request):
+            raise GoogleAdsException(None, None, None, None)
+
+    monkeypatch.setattr(app, "get_google_ads_client", make_google_ads_client)
+    monkeypatch.setattr(app, "get_geo_target_constant_service", lambda: FailingGeoTargetConstantService())
+
+    assert asyncio.run(app.suggest_geo_target_constant("MA")) == app.LOCATION_MAPPING["US"]
+    assert "MA" not in app.geo_target_constant_cache